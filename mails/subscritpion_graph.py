@@ -1,21 +1,24 @@
 # create_subscription.py
+import asyncio
 from datetime import datetime, timedelta, timezone
-import requests
-from graph_client import get_token, MAILBOX
-from main import EXPECTED_CLIENT_STATE  # ou duplique la valeur
 import os
+
+from test_graph import _request_with_retry, close_session, get_token, MAILBOX
+
 try:
     # Chargement automatique du fichier .env s'il existe
-    from dotenv import load_dotenv, find_dotenv  # type: ignore
+    from dotenv import load_dotenv  # type: ignore
 except Exception:
     load_dotenv = None  # type: ignore
-    find_dotenv = None  # type: ignore
 
-load_dotenv()
+if load_dotenv is not None:
+    load_dotenv()
 NOTIFICATION_URL = os.getenv("NOTIFICATION_URL")
+EXPECTED_CLIENT_STATE = os.getenv("EXPECTED_CLIENT_STATE")
 
-def create_subscription():
-    token = get_token()
+
+async def create_subscription():
+    token = await get_token()
     expiration = datetime.now(timezone.utc) + timedelta(hours=1)  # ou max autorisé
 
     body = {
@@ -26,12 +29,26 @@ def create_subscription():
         "clientState": EXPECTED_CLIENT_STATE,
     }
 
-    resp = requests.post(
+    data = await _request_with_retry(
+        "POST",
         "https://graph.microsoft.com/v1.0/subscriptions",
         headers={"Authorization": f"Bearer {token}"},
         json=body,
     )
-    print(resp.status_code, resp.json())
+    print(data)
+
+
+def create_subscription_sync():
+    """Shim synchrone pour les usages CLI."""
+
+    async def _main():
+        try:
+            return await create_subscription()
+        finally:
+            await close_session()
+
+    return asyncio.run(_main())
+
 
 if __name__ == "__main__":
-    create_subscription()
+    create_subscription_sync()
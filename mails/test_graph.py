@@ -1,20 +1,108 @@
-import requests
+import asyncio
 import os
+import time
+from typing import Optional
+
+import aiohttp
+
 try:
     # Chargement automatique du fichier .env s'il existe
-    from dotenv import load_dotenv, find_dotenv  # type: ignore
+    from dotenv import load_dotenv  # type: ignore
 except Exception:
     load_dotenv = None  # type: ignore
-    find_dotenv = None  # type: ignore
 
-load_dotenv()
+if load_dotenv is not None:
+    load_dotenv()
 TENANT_ID = os.getenv("AZURE_TENANT_ID")
 CLIENT_ID = os.getenv("AZURE_AIAC_MAIL_APP_ID")
 CLIENT_SECRET = os.getenv("AZURE_AIAC_MAIL_APP_SECRET")
 MAILBOX = "alexandre.combes@foaster.ai"
 
-def get_token():
-    resp = requests.post(
+# Session aiohttp partagée entre tous les appels Graph/OAuth du process :
+# on réutilise les connexions TCP/TLS au lieu d'en rouvrir une par requête.
+# Une ClientSession est liée à l'event loop qui l'a créée : on mémorise cette
+# loop pour recréer la session si un asyncio.run ultérieur en démarre une autre.
+_session: Optional[aiohttp.ClientSession] = None
+_session_loop: Optional[asyncio.AbstractEventLoop] = None
+
+# Cache de token en mémoire, par tenant. L'expiration vient du champ
+# `expires_in` renvoyé par l'IdP, avec une marge de sécurité de 60 s.
+_TOKEN_CACHE: dict = {}
+_TOKEN_SAFETY_WINDOW = 60.0
+
+
+MAX_RETRIES = int(os.getenv("GRAPH_MAX_RETRIES", "5"))
+
+# Statuts transitoires de Microsoft Graph sur lesquels on retente.
+_RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+def _get_session() -> aiohttp.ClientSession:
+    """
+    Retourne la session aiohttp partagée, en la créant au premier appel.
+
+    La session est recréée si elle a été fermée ou si elle appartient à une
+    autre event loop (asyncio.run successifs dans le même process).
+    """
+    global _session, _session_loop
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300, keepalive_timeout=60)
+        )
+        _session_loop = loop
+    return _session
+
+
+async def close_session() -> None:
+    """
+    Ferme la session partagée. À appeler avant la fin de l'event loop (les
+    shims synchrones s'en chargent), sinon aiohttp émet des avertissements
+    "Unclosed client session" à la sortie.
+    """
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def _request_with_retry(method: str, url: str, **kw) -> dict:
+    """
+    Effectue une requête HTTP avec backoff exponentiel sur les statuts
+    transitoires (429/5xx), en respectant l'en-tête Retry-After si présent.
+
+    Retourne le corps JSON décodé ; lève sur erreur non-transitoire ou après
+    MAX_RETRIES tentatives.
+    """
+    session = _get_session()
+    for attempt in range(MAX_RETRIES):
+        async with session.request(method, url, **kw) as resp:
+            if resp.status in _RETRYABLE_STATUSES and attempt < MAX_RETRIES - 1:
+                retry_after = resp.headers.get("Retry-After")
+                if retry_after and retry_after.isdigit():
+                    delay = float(retry_after)
+                else:
+                    delay = min(2 ** attempt, 30)
+                await asyncio.sleep(delay)
+                continue
+            resp.raise_for_status()
+            return await resp.json()
+    raise RuntimeError(f"Requête {method} {url} en échec après {MAX_RETRIES} tentatives.")
+
+
+async def get_token() -> str:
+    """
+    Récupère un token OAuth2 client_credentials pour Microsoft Graph.
+
+    Le token est mis en cache en mémoire (clé = tenant) pour éviter de refaire
+    l'aller-retour OAuth à chaque appel dans le même process.
+    """
+    cached = _TOKEN_CACHE.get(TENANT_ID)
+    if cached and time.monotonic() < cached["exp"] - _TOKEN_SAFETY_WINDOW:
+        return cached["value"]
+
+    data = await _request_with_retry(
+        "POST",
         f"https://login.microsoftonline.com/{TENANT_ID}/oauth2/v2.0/token",
         data={
             "client_id": CLIENT_ID,
@@ -23,13 +111,42 @@ def get_token():
             "grant_type": "client_credentials",
         },
     )
-    resp.raise_for_status()
-    return resp.json()["access_token"]
 
-token = get_token()
+    token = data["access_token"]
+    expires_in = float(data.get("expires_in", 3600))
+    _TOKEN_CACHE[TENANT_ID] = {"value": token, "exp": time.monotonic() + expires_in}
+    return token
+
+
+def get_token_sync() -> str:
+    """Shim synchrone pour les usages CLI / scripts non-async."""
+
+    async def _main() -> str:
+        try:
+            return await get_token()
+        finally:
+            await close_session()
+
+    return asyncio.run(_main())
+
+
+async def _list_last_messages(top: int = 5) -> None:
+    """Affiche les derniers messages de la boîte (usage debug en ligne de commande)."""
+    token = await get_token()
+    data = await _request_with_retry(
+        "GET",
+        f"https://graph.microsoft.com/v1.0/users/{MAILBOX}/messages?$top={top}",
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    print(data)
+
+
+async def _main() -> None:
+    try:
+        await _list_last_messages()
+    finally:
+        await close_session()
+
 
-resp = requests.get(
-    f"https://graph.microsoft.com/v1.0/users/{MAILBOX}/messages?$top=5",
-    headers={"Authorization": f"Bearer {token}"},
-)
-print(resp.status_code, resp.json())
+if __name__ == "__main__":
+    asyncio.run(_main())
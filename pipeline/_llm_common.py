@@ -0,0 +1,117 @@
+"""Helpers partagés par les services LLM (id_mail_json, json_service).
+
+Centralise le nettoyage/parsing des sorties texte des modèles, le client
+Azure OpenAI mis en cache, le limiteur de débit et les constantes de retry :
+une seule copie compilée à l'import au lieu d'une par module.
+"""
+
+import functools
+import json
+import os
+import re
+
+from openai import OpenAI
+
+from ._rate_limit import AZURE_LIMITER
+
+__all__ = [
+    "API_TIMEOUT",
+    "MAX_RETRIES",
+    "RETRY_DELAY",
+    "AZURE_LIMITER",
+    "get_azure_client",
+    "get_openai_client",
+    "strip_fences_and_think",
+    "parse_json_array",
+    "json_loads",
+    "json_dumps",
+    "json_dumps_pretty",
+]
+
+API_TIMEOUT = int(os.getenv("API_TIMEOUT", "300"))
+MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", "3"))
+RETRY_DELAY = int(os.getenv("API_RETRY_DELAY", "5"))
+
+try:
+    # orjson (parseur C/SIMD) est ~3-10x plus rapide que le json stdlib sur
+    # les payloads typiques ; fallback silencieux si non installé.
+    import orjson  # type: ignore
+
+    json_loads = orjson.loads
+
+    def json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+
+    def json_dumps_pretty(obj) -> bytes:
+        """Sérialise en JSON indenté (2 espaces), UTF-8, prêt pour write_bytes."""
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+
+except ImportError:  # pragma: no cover - fallback stdlib
+    json_loads = json.loads
+    json_dumps = json.dumps
+
+    def json_dumps_pretty(obj) -> bytes:
+        """Sérialise en JSON indenté (2 espaces), UTF-8, prêt pour write_bytes."""
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+
+
+# Compilé une seule fois à l'import : évite le dispatch re.sub + lookup du
+# cache de patterns à chaque réponse LLM.
+_THINK_RE = re.compile(r"<think>[\s\S]*?</think>")
+
+_DECODER = json.JSONDecoder()
+
+
+@functools.lru_cache(maxsize=4)
+def get_openai_client(endpoint: str, api_key: str) -> OpenAI:
+    """
+    Client OpenAI mis en cache par (endpoint, api_key).
+
+    Tous les services du process qui parlent au même endpoint partagent donc
+    le même client httpx — et son pool de connexions / sessions TLS — au lieu
+    d'en reconstruire un par module ou par appel.
+    """
+    base_url = endpoint.rstrip('/') + "/openai/v1/"
+    return OpenAI(api_key=api_key, base_url=base_url, timeout=API_TIMEOUT)
+
+
+def get_azure_client() -> OpenAI:
+    """Client Azure OpenAI configuré depuis l'environnement."""
+    endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
+    deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT")
+    api_key = os.getenv("AZURE_OPENAI_API_KEY")
+    if not (endpoint and deployment and api_key):
+        raise RuntimeError("Variables Azure manquantes: AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_DEPLOYMENT, AZURE_OPENAI_API_KEY")
+    return get_openai_client(endpoint, api_key)
+
+
+def strip_fences_and_think(raw: str) -> str:
+    """
+    Supprime les blocs <think>...</think> et les fences Markdown (```json / ```)
+    autour d'une réponse LLM brute.
+    """
+    s = _THINK_RE.sub("", raw.strip()).strip()
+    s = s.removeprefix("```json").removeprefix("```").removesuffix("```")
+    return s.strip()
+
+
+def parse_json_array(s: str):
+    """
+    Parse le premier tableau JSON top-level trouvé dans `s`.
+
+    raw_decode s'arrête à la première valeur équilibrée : un seul passage,
+    pas de rfind("]") ni de copie de sous-chaîne, et tolérant au texte que
+    le modèle peut émettre après le `]` final. Si le modèle renvoie un objet
+    unique plutôt qu'un tableau, on l'encapsule dans un tableau. Retourne
+    None si rien de parsable.
+    """
+    # On décode à partir du premier `[` ou `{` rencontré (dans cet ordre
+    # d'apparition : un `[` peut appartenir à une valeur interne d'un objet
+    # top-level, et réciproquement), puis on retente sur l'autre en repli.
+    for i in sorted(i for i in (s.find("["), s.find("{")) if i >= 0):
+        try:
+            obj, _ = _DECODER.raw_decode(s, i)
+        except json.JSONDecodeError:
+            continue
+        return obj if isinstance(obj, list) else [obj]
+    return None
@@ -0,0 +1,31 @@
+"""Limiteur de débit partagé pour les appels Azure OpenAI.
+
+Le sémaphore de concurrence borne le nombre d'appels en vol ; ce limiteur
+borne le débit en régime permanent (intervalle minimum entre deux départs)
+pour ne pas épuiser les quotas RPM/TPM quand la concurrence augmente.
+"""
+
+import asyncio
+import os
+import time
+
+
+class RateLimiter:
+    """Token-bucket minimaliste : impose un intervalle minimum entre requêtes."""
+
+    def __init__(self, rps: float):
+        self.interval = 1.0 / rps
+        self.next = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        async with self.lock:
+            now = time.monotonic()
+            delay = max(0.0, self.next - now)
+            self.next = max(now, self.next) + self.interval
+        if delay:
+            await asyncio.sleep(delay)
+
+
+# Limiteur partagé par tous les services Azure du process (RPS via env).
+AZURE_LIMITER = RateLimiter(float(os.getenv("AZURE_RPS", "4")))
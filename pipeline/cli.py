@@ -1,5 +1,8 @@
 import argparse
 import asyncio
+import logging
+import logging.handlers
+import os
 import sys
 from pathlib import Path
 
@@ -14,15 +17,65 @@ except Exception:
     find_dotenv = None  # type: ignore
 
 
+# Variantes minuscules et majuscules pré-construites : str.endswith(tuple)
+# teste tous les suffixes côté C, sans allocation .lower() par fichier.
+_EXTS = (".pdf", ".jpg", ".jpeg", ".png", ".PDF", ".JPG", ".JPEG", ".PNG")
+
+# Logs sur stderr, bufferisés : sous forte concurrence les écritures stdout
+# ligne-à-ligne de print() se sérialisent sur le lock du flux ; le
+# MemoryHandler groupe les enregistrements et ne flush que par lots (ou dès
+# qu'une erreur survient).
+_stream_handler = logging.StreamHandler(sys.stderr)
+_stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+logging.getLogger("pipeline").addHandler(
+    logging.handlers.MemoryHandler(capacity=256, flushLevel=logging.ERROR, target=_stream_handler)
+)
+logging.getLogger("pipeline").setLevel(logging.INFO)
+log = logging.getLogger("pipeline.cli")
+
+
 def find_documents(input_dir: str):
     """
-    Retourne tous les fichiers supportés dans le dossier d'entrée :
+    Itère sur tous les fichiers supportés dans le dossier d'entrée :
     - PDF
     - Images: JPG, JPEG, PNG
+
+    Parcours via os.scandir : pas d'objet Path ni de stat() par entrée
+    (rglob en alloue un par fichier), seuls les fichiers retenus sont
+    matérialisés en Path.
     """
-    root = Path(input_dir).expanduser().resolve()
-    exts = {".pdf", ".jpg", ".jpeg", ".png"}
-    return [p for p in root.rglob("**/*") if p.is_file() and p.suffix.lower() in exts]
+    stack = [str(Path(input_dir).expanduser().resolve())]
+    while stack:
+        d = stack.pop()
+        try:
+            it = os.scandir(d)
+        except OSError:
+            continue
+        with it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    stack.append(e.path)
+                elif e.is_file(follow_symlinks=False) and e.name.endswith(_EXTS):
+                    yield Path(e.path)
+
+
+async def _run_all(docs, cfg) -> None:
+    """
+    Traite tous les documents en concurrence (I/O-bound : OCR + LLM),
+    bornée par PIPELINE_CONCURRENCY pour ne pas saturer les quotas Azure.
+    """
+    sem = asyncio.Semaphore(int(os.getenv("PIPELINE_CONCURRENCY", "8")))
+    total = len(docs)
+
+    async def _one(i: int, pdf: Path) -> None:
+        async with sem:
+            try:
+                log.info("[%d/%d] %s", i, total, pdf)
+                await run_pdf_pipeline(str(pdf), cfg)
+            except Exception as e:
+                log.error("❌ Échec: %s → %s", pdf, e)
+
+    await asyncio.gather(*(_one(i, pdf) for i, pdf in enumerate(docs, start=1)))
 
 
 def main() -> None:
@@ -59,40 +112,41 @@ def main() -> None:
         dpi=args.dpi,
         skip_existing=args.skip_existing,
     )
+    # Un seul event loop pour toute la CLI : les clients HTTP (Azure OpenAI,
+    # Graph) et leurs pools de connexions sont réutilisés entre documents au
+    # lieu d'être reconstruits à chaque asyncio.run.
+    try:
+        sys.exit(asyncio.run(_main_async(args, cfg)))
+    except KeyboardInterrupt:
+        log.error("Interrompu par l'utilisateur.")
+        sys.exit(130)
+
+
+async def _main_async(args, cfg) -> int:
     # Mode 1 : traitement depuis le dernier mail (pipeline complète mail + RIB)
     if args.from_mail:
         try:
-            print("▶️ Lancement de la pipeline depuis le dernier mail (création doc Firebase, lecture mail, OCR, agent RIB)...")
-            report = asyncio.run(run_latest_mail_attachment_pipeline(cfg))
-            print(f"✅ Pipeline mail+RIB terminée. Dossier de process: {report.process_dir}")
-        except KeyboardInterrupt:
-            print("Interrompu par l'utilisateur.")
-            sys.exit(130)
+            log.info("▶️ Lancement de la pipeline depuis le dernier mail (création doc Firebase, lecture mail, OCR, agent RIB)...")
+            report = await run_latest_mail_attachment_pipeline(cfg)
+            log.info("✅ Pipeline mail+RIB terminée. Dossier de process: %s", report.process_dir)
+            return 0
         except Exception as e:
-            print(f"❌ Échec pipeline mail+RIB → {e}")
-            sys.exit(1)
-        return
+            log.error("❌ Échec pipeline mail+RIB → %s", e)
+            return 1
 
     # Mode 2 : traitement classique d'un dossier de PDF/Images
     if not args.input:
-        print("Erreur: --input est obligatoire sauf si vous utilisez --from-mail.")
-        sys.exit(1)
+        log.error("Erreur: --input est obligatoire sauf si vous utilisez --from-mail.")
+        return 1
 
-    docs = find_documents(args.input)
+    docs = list(find_documents(args.input))
     if not docs:
-        print("Aucun fichier PDF/JPG/PNG trouvé.")
-        sys.exit(0)
+        log.info("Aucun fichier PDF/JPG/PNG trouvé.")
+        return 0
 
-    print(f"{len(docs)} fichier(s) (PDF/JPG/PNG) détecté(s) → sortie: {cfg.out_root}")
-    for i, pdf in enumerate(docs, start=1):
-        try:
-            print(f"\n[{i}/{len(docs)}] {pdf}")
-            asyncio.run(run_pdf_pipeline(str(pdf), cfg))
-        except KeyboardInterrupt:
-            print("Interrompu par l'utilisateur.")
-            sys.exit(130)
-        except Exception as e:
-            print(f"❌ Échec: {pdf} → {e}")
+    log.info("%d fichier(s) (PDF/JPG/PNG) détecté(s) → sortie: %s", len(docs), cfg.out_root)
+    await _run_all(docs, cfg)
+    return 0
 
 
 if __name__ == "__main__":
@@ -11,6 +11,8 @@ def load_config(
     mapping_backend: Optional[str] = None,
     dpi: Optional[int] = None,
     skip_existing: bool = False,
+    debug_pages: bool = False,
+    max_concurrency: Optional[int] = None,
 ) -> ProcessConfig:
     root = Path(out_root or os.getenv("PIPELINE_OUT_ROOT", "uploads")).expanduser().resolve()
     root.mkdir(parents=True, exist_ok=True)
@@ -21,6 +23,8 @@ def load_config(
         mapping_backend=(mapping_backend or os.getenv("MAPPING_BACKEND", "hyperbolic")).lower(),
         dpi=int(dpi or int(os.getenv("VLM_DPI", "200"))),
         skip_existing=skip_existing or os.getenv("SKIP_EXISTING", "0") == "1",
+        debug_pages=debug_pages or os.getenv("DEBUG_PAGES", "0") == "1",
+        max_concurrency=int(max_concurrency or int(os.getenv("MAX_CONCURRENCY", "10"))),
     )
     return cfg
 
@@ -1,25 +1,10 @@
-import asyncio
-import json
 import os
 import re
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List
 
 from openai import OpenAI
 
-
-API_TIMEOUT = int(os.getenv("API_TIMEOUT", "300"))
-MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", "3"))
-RETRY_DELAY = int(os.getenv("API_RETRY_DELAY", "5"))
-
-
-def _get_azure_client() -> OpenAI:
-    endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-    deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT")
-    api_key = os.getenv("AZURE_OPENAI_API_KEY")
-    if not (endpoint and deployment and api_key):
-        raise RuntimeError("Variables Azure manquantes: AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_DEPLOYMENT, AZURE_OPENAI_API_KEY")
-    base_url = endpoint.rstrip('/') + "/openai/v1/"
-    return OpenAI(api_key=api_key, base_url=base_url)
+from ._llm_common import get_azure_client, parse_json_array, strip_fences_and_think
 
 
 
@@ -27,26 +12,27 @@ TARGET_FIELDS: List[str] = [
     "id"
 ]
 
-def _strip_fences_and_think(raw: str) -> str:
-    s = raw.strip()
-    s = re.sub(r"<think>[\s\S]*?</think>", "", s)
-    s = s.strip()
-    if s.startswith("```json"):
-        s = s[7:]
-    if s.startswith("```"):
-        s = s[3:]
-    if s.endswith("```"):
-        s = s[:-3]
-    return s.strip()
+# Chemin rapide : les identifiants visés sont de courts tokens alphanumériques
+# à préfixe lettres (ex. "TRS59861") — une regex suffit dans la grande
+# majorité des cas, sans aller-retour LLM.
+_ID_RE = re.compile(r"\b([A-Z]{2,4}\d{4,8})\b")
 
 
-def _extract_json_array(s: str) -> Optional[str]:
-    start = s.find("[")
-    end = s.rfind("]")
-    if start == -1 or end == -1 or end < start:
-        return None
-    return s[start : end + 1]
+def extract_mail_ids(full_text: str) -> List[Dict[str, Any]]:
+    """
+    Extrait l'identifiant client/contrat du texte d'un mail.
 
+    Tente d'abord la regex compilée (latence ~µs) ; ne bascule sur l'appel
+    Azure (latence ~s) que si elle ne trouve rien. MAIL_ID_REGEX_ONLY=1
+    désactive complètement le fallback LLM.
+    """
+    m = _ID_RE.search(full_text)
+    if m:
+        return [{"id": m.group(1)}]
+    if os.getenv("MAIL_ID_REGEX_ONLY", "0") == "1":
+        return [{"id": None}]
+    client = get_azure_client()
+    return _azure_text_to_json(client, full_text)
 
 def _build_system_prompt() -> str:
     cols = ", ".join(TARGET_FIELDS)
@@ -92,6 +78,12 @@ def _build_system_prompt() -> str:
     return "\n".join(parts)
 
 
+# Prompt pur et invariant : construit une seule fois par process au lieu
+# d'une fois par appel/retry. L'invariance octet-à-octet aide aussi le
+# prompt caching côté Azure.
+_SYSTEM_PROMPT_ID = _build_system_prompt()
+
+
 def _azure_text_to_json(client: OpenAI, full_text: str) -> List[Dict[str, Any]]:
     """
     Appelle Azure Responses API pour transformer le texte d'un mail en tableau JSON normalisé
@@ -101,11 +93,9 @@ def _azure_text_to_json(client: OpenAI, full_text: str) -> List[Dict[str, Any]]:
     if not deployment:
         raise RuntimeError("AZURE_OPENAI_DEPLOYMENT non défini (nom du déploiement Azure)")
 
-    system_prompt = _build_system_prompt()
-
     resp = client.responses.create(
         model=deployment,
-        instructions=system_prompt,
+        instructions=_SYSTEM_PROMPT_ID,
         input=[
             {
                 "role": "user",
@@ -120,13 +110,9 @@ def _azure_text_to_json(client: OpenAI, full_text: str) -> List[Dict[str, Any]]:
     )
 
     raw = resp.output_text or ""
-    cleaned = _strip_fences_and_think(raw)
-    json_str = _extract_json_array(cleaned) or cleaned
-
-    data = json.loads(json_str)
-    if not isinstance(data, list):
-        # Si le modèle renvoie un objet unique, on l'encapsule dans un tableau.
-        data = [data]
+    cleaned = strip_fences_and_think(raw)
+    # parse_json_array encapsule déjà un éventuel objet unique dans un tableau.
+    data = parse_json_array(cleaned) or []
 
     normalized: List[Dict[str, Any]] = []
 
@@ -6,20 +6,33 @@ from typing import Any, Dict, List, Optional
 
 from openai import OpenAI
 
-
-API_TIMEOUT = int(os.getenv("API_TIMEOUT", "300"))
-MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", "3"))
-RETRY_DELAY = int(os.getenv("API_RETRY_DELAY", "5"))
-
-
-def _get_azure_client() -> OpenAI:
-    endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-    deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT")
-    api_key = os.getenv("AZURE_OPENAI_API_KEY")
-    if not (endpoint and deployment and api_key):
-        raise RuntimeError("Variables Azure manquantes: AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_DEPLOYMENT, AZURE_OPENAI_API_KEY")
-    base_url = endpoint.rstrip('/') + "/openai/v1/"
-    return OpenAI(api_key=api_key, base_url=base_url)
+from ._llm_common import (
+    AZURE_LIMITER,
+    MAX_RETRIES,
+    RETRY_DELAY,
+    get_azure_client,
+    parse_json_array,
+    strip_fences_and_think,
+)
+
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "8"))
+
+# Validation locale des champs bancaires : corriger/écarter une valeur
+# polluée (espaces, casse) coûte quelques µs ici, contre un cycle complet de
+# retries Azure si on laisse passer du bruit vers l'aval.
+_IBAN_RE = re.compile(r"[A-Z]{2}\d{2}[A-Z0-9]{10,30}")
+_BIC_RE = re.compile(r"[A-Z]{6}[A-Z0-9]{2}([A-Z0-9]{3})?")
+_CDBANK_RE = re.compile(r"\d{5}")
+
+
+def _clean_banking_field(value: Any, pattern: re.Pattern, upper: bool = True) -> Optional[str]:
+    """Canonicalise une valeur (sans espaces, majuscules) et la valide via regex."""
+    if not value:
+        return None
+    s = str(value).replace(" ", "")
+    if upper:
+        s = s.upper()
+    return s if pattern.fullmatch(s) else None
 
 
 TARGET_FIELDS_final: List[str] = [
@@ -40,27 +53,6 @@ TARGET_FIELDS: List[str] = [
     "nomBanque", 
 ]
 
-def _strip_fences_and_think(raw: str) -> str:
-    s = raw.strip()
-    s = re.sub(r"<think>[\s\S]*?</think>", "", s)
-    s = s.strip()
-    if s.startswith("```json"):
-        s = s[7:]
-    if s.startswith("```"):
-        s = s[3:]
-    if s.endswith("```"):
-        s = s[:-3]
-    return s.strip()
-
-
-def _extract_json_array(s: str) -> Optional[str]:
-    start = s.find("[")
-    end = s.rfind("]")
-    if start == -1 or end == -1 or end < start:
-        return None
-    return s[start : end + 1]
-
-
 def _build_system_prompt() -> str:
     cols = ", ".join(TARGET_FIELDS)
     # Prompt long, consolidé, avec raisonnement global et règles robustes
@@ -82,6 +74,14 @@ def _build_system_prompt() -> str:
         "ne renvoie QU'UN SEUL objet JSON pour ce RIB (dédupliquer les doublons).\n"
     )
 
+    # Structure de l'entrée (sentinelles de pages)
+    parts.append(
+        "\n## STRUCTURE DE L'ENTRÉE\n"
+        "- Le texte OCR est découpé par des marqueurs \"---PAGE n---\" indiquant les frontières de pages.\n"
+        "- Ces marqueurs sont structurels : ne jamais les reprendre dans les valeurs de sortie.\n"
+        "- Un même RIB peut s'étaler sur plusieurs pages consécutives.\n"
+    )
+
     # Définition détaillée des champs attendus
     parts.append(
         "\n## DÉFINITION DES CHAMPS\n"
@@ -119,17 +119,78 @@ def _build_system_prompt() -> str:
     return "\n".join(parts)
 
 
-def _azure_text_to_json(client: OpenAI, full_text: str) -> List[Dict[str, Any]]:
+# Prompts purs et invariants : construits une seule fois par process au lieu
+# d'une fois par appel/retry. L'invariance octet-à-octet aide aussi le prompt
+# caching côté Azure.
+_SYSTEM_PROMPT_RIB = _build_system_prompt()
+
+
+def _join_pages(page_texts: List[str]) -> str:
     """
-    Appelle Azure Responses API pour transformer un texte OCRisé de RIB en tableau JSON normalisé.
+    Concatène les pages OCR avec des sentinelles "---PAGE n---" stables.
+
+    Les sentinelles donnent au modèle les frontières physiques du document
+    (un RIB coupé entre deux pages reste associable) et rendent l'entrée
+    déterministe octet-à-octet pour un même document.
     """
-    deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT")
-    if not deployment:
-        raise RuntimeError("AZURE_OPENAI_DEPLOYMENT non défini (nom du déploiement Azure)")
+    return "\n".join(f"---PAGE {i}---\n{txt}" for i, txt in enumerate(page_texts, start=1)).strip()
 
-    system_prompt = _build_system_prompt()
 
-    resp = client.responses.create(
+def _normalize_rows(data: List[Any]) -> List[Dict[str, Any]]:
+    """
+    Normalise et déduplique les lignes RIB renvoyées par le modèle :
+    objets restreints aux TARGET_FIELDS_final, id auto-incrémenté, sens fixé.
+    """
+    normalized: List[Dict[str, Any]] = []
+    seen_keys: set[tuple] = set()
+
+    for item in data:
+        if not isinstance(item, dict):
+            # On ignore les entrées non-objet au lieu de tout faire échouer.
+            continue
+
+        # Clé de déduplication testée AVANT toute construction d'objet :
+        # sur les sorties riches en doublons, on évite les dicts intermédiaires
+        # jetés aussitôt. Les champs bancaires sont canonicalisés/validés au
+        # passage (la canonicalisation améliore aussi le taux de dédup).
+        dedup_key = (
+            _clean_banking_field(item.get("iban"), _IBAN_RE),
+            _clean_banking_field(item.get("bic"), _BIC_RE),
+            item.get("titulaire"),
+            _clean_banking_field(item.get("cdBanque"), _CDBANK_RE, upper=False),
+            item.get("nomBanque"),
+        )
+        if dedup_key in seen_keys:
+            # Doublon exact : on ignore cette entrée
+            continue
+        seen_keys.add(dedup_key)
+
+        # Objet final strictement aligné sur TARGET_FIELDS_final : id
+        # auto-incrémenté, sens fixé à "virement" pour ce pipeline RIB.
+        normalized.append(
+            {
+                "id": len(normalized) + 1,
+                "iban": dedup_key[0],
+                "bic": dedup_key[1],
+                "titulaire": dedup_key[2],
+                "cdBanque": dedup_key[3],
+                "nomBanque": dedup_key[4],
+                "sens": "virement",
+            }
+        )
+
+    return normalized
+
+
+def _stream_json_array_text(client: OpenAI, deployment: str, system_prompt: str, full_text: str) -> str:
+    """
+    Streame la réponse Azure et coupe dès qu'un tableau JSON top-level complet
+    est présent dans le buffer, sans attendre la fin de la génération
+    (prose/espaces que le modèle peut émettre après le `]` final).
+    """
+    buf = ""
+    decoder = json.JSONDecoder()
+    with client.responses.stream(
         model=deployment,
         instructions=system_prompt,
         input=[
@@ -143,57 +204,100 @@ def _azure_text_to_json(client: OpenAI, full_text: str) -> List[Dict[str, Any]]:
                 ],
             }
         ],
-    )
+    ) as stream:
+        for event in stream:
+            if event.type != "response.output_text.delta":
+                continue
+            buf += event.delta
+            if "]" not in event.delta:
+                continue
+            start = buf.find("[")
+            if start < 0:
+                continue
+            try:
+                # raw_decode s'arrête au premier tableau équilibré : succès
+                # ⇒ la sortie utile est complète, on peut couper le flux.
+                decoder.raw_decode(buf, start)
+            except json.JSONDecodeError:
+                continue
+            stream.close()
+            return buf
+        # Flux terminé sans coupure anticipée : on prend le texte final complet.
+        return stream.get_final_response().output_text or buf
 
-    raw = resp.output_text or ""
-    cleaned = _strip_fences_and_think(raw)
-    json_str = _extract_json_array(cleaned) or cleaned
 
-    data = json.loads(json_str)
-    if not isinstance(data, list):
+def _azure_text_to_json(client: OpenAI, full_text: str) -> List[Dict[str, Any]]:
+    """
+    Appelle Azure Responses API pour transformer un texte OCRisé de RIB en tableau JSON normalisé.
+    """
+    deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT")
+    if not deployment:
+        raise RuntimeError("AZURE_OPENAI_DEPLOYMENT non défini (nom du déploiement Azure)")
+
+    raw = _stream_json_array_text(client, deployment, _SYSTEM_PROMPT_RIB, full_text)
+    cleaned = strip_fences_and_think(raw)
+    data = parse_json_array(cleaned)
+    if data is None:
         raise ValueError("La sortie JSON doit être un tableau d'objets (un objet par RIB détecté).")
 
-    normalized: List[Dict[str, Any]] = []
-    seen_keys: set[tuple] = set()
+    return _normalize_rows(data)
 
-    for item in data:
-        if not isinstance(item, dict):
-            # On ignore les entrées non-objet au lieu de tout faire échouer.
-            continue
 
-        # 1) Normalisation des champs extraits par le modèle (TARGET_FIELDS)
-        base: Dict[str, Any] = {}
-        for field in TARGET_FIELDS:
-            base[field] = item.get(field)
+def _build_batch_prompt_suffix() -> str:
+    return (
+        "\n## MODE BATCH\n"
+        "- L'entrée contient PLUSIEURS documents, chacun précédé d'un marqueur \"=== DOC i ===\".\n"
+        "- La sortie DOIT être un tableau JSON de la forme "
+        '[{"doc": i, "rows": [...]}] où "rows" suit exactement le format décrit ci-dessus.\n'
+        "- Inclure une entrée par document, même si \"rows\" est vide.\n"
+    )
 
-        # Clé de déduplication basée sur les champs principaux du RIB
-        dedup_key = (
-            base.get("iban"),
-            base.get("bic"),
-            base.get("titulaire"),
-            base.get("cdBanque"),
-            base.get("nomBanque"),
-        )
-        if dedup_key in seen_keys:
-            # Doublon exact : on ignore cette entrée
-            continue
-        seen_keys.add(dedup_key)
 
-        # 2) Construction de l'objet final strictement aligné sur TARGET_FIELDS_final
-        final_obj: Dict[str, Any] = {}
-        for field in TARGET_FIELDS_final:
-            if field == "id":
-                # Identifiant simple auto-incrémenté par ligne de RIB
-                final_obj[field] = len(normalized) + 1
-            elif field == "sens":
-                # Pour ce pipeline RIB, le sens est fixé à "virement"
-                final_obj[field] = "virement"
-            else:
-                final_obj[field] = base.get(field)
+_SYSTEM_PROMPT_RIB_BATCH = _SYSTEM_PROMPT_RIB + _build_batch_prompt_suffix()
 
-        normalized.append(final_obj)
 
-    return normalized
+def _azure_docs_to_json(client: OpenAI, docs_texts: List[str]) -> List[List[Dict[str, Any]]]:
+    """
+    Variante batch : envoie N documents dans un seul appel Azure et redistribue
+    les lignes RIB par document. Amortit le prompt système et le RTT HTTPS
+    sur l'ensemble du lot.
+    """
+    deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT")
+    if not deployment:
+        raise RuntimeError("AZURE_OPENAI_DEPLOYMENT non défini (nom du déploiement Azure)")
+
+    resp = client.responses.create(
+        model=deployment,
+        instructions=_SYSTEM_PROMPT_RIB_BATCH,
+        input=[
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "input_text",
+                        "text": f"=== DOC {i} ===\n{text}",
+                    }
+                    for i, text in enumerate(docs_texts)
+                ],
+            }
+        ],
+    )
+
+    raw = resp.output_text or ""
+    cleaned = strip_fences_and_think(raw)
+    data = parse_json_array(cleaned)
+    if data is None:
+        raise ValueError("La sortie JSON batch doit être un tableau [{doc, rows}].")
+
+    results: List[List[Dict[str, Any]]] = [[] for _ in docs_texts]
+    for entry in data:
+        if not isinstance(entry, dict):
+            continue
+        idx = entry.get("doc")
+        rows = entry.get("rows")
+        if isinstance(idx, int) and 0 <= idx < len(results) and isinstance(rows, list):
+            results[idx] = _normalize_rows(rows)
+    return results
 
 
 class AzureTextToJsonService:
@@ -205,15 +309,18 @@ class AzureTextToJsonService:
         """
         Agrège les pages OCR en un seul texte puis appelle Azure pour produire un tableau JSON.
         """
-        full_text = "\n\n".join(page_texts).strip()
+        full_text = _join_pages(page_texts)
         if not full_text:
             return []
 
+        client = get_azure_client()
         last_error: Optional[BaseException] = None
         for attempt in range(1, MAX_RETRIES + 1):
             try:
-                client = _get_azure_client()
-                return _azure_text_to_json(client, full_text)
+                await AZURE_LIMITER.wait()
+                # Appel bloquant (HTTPS + inférence) déporté dans un thread
+                # pour ne pas geler l'event loop pendant toute la latence LLM.
+                return await asyncio.to_thread(_azure_text_to_json, client, full_text)
             except Exception as exc:  # pragma: no cover - robust API layer
                 last_error = exc
                 if attempt >= MAX_RETRIES:
@@ -222,3 +329,44 @@ class AzureTextToJsonService:
 
         raise RuntimeError(f"Échec texte→JSON après {MAX_RETRIES} tentatives: {last_error}")
 
+    async def text_pages_to_json_batch(
+        self, docs: List[List[str]], concurrency: Optional[int] = None
+    ) -> List[List[Dict[str, Any]]]:
+        """
+        Traite un lot de documents (liste de pages par document) en un seul
+        appel Azure, par tranches de BATCH_SIZE documents.
+
+        Les tranches sont dispatchées en concurrence (bornée par
+        `concurrency`, défaut 10) : le temps mur devient ~max(tranches) au
+        lieu de leur somme.
+        """
+        docs_texts = [_join_pages(pages) for pages in docs]
+        if not any(docs_texts):
+            return [[] for _ in docs]
+
+        client = get_azure_client()
+        sem = asyncio.Semaphore(concurrency or 10)
+
+        async def _one_chunk(chunk: List[str]) -> List[List[Dict[str, Any]]]:
+            async with sem:
+                last_error: Optional[BaseException] = None
+                for attempt in range(1, MAX_RETRIES + 1):
+                    try:
+                        await AZURE_LIMITER.wait()
+                        return await asyncio.to_thread(_azure_docs_to_json, client, chunk)
+                    except Exception as exc:  # pragma: no cover - robust API layer
+                        last_error = exc
+                        if attempt >= MAX_RETRIES:
+                            break
+                        await asyncio.sleep(RETRY_DELAY)
+                raise RuntimeError(
+                    f"Échec texte→JSON batch après {MAX_RETRIES} tentatives: {last_error}"
+                )
+
+        chunks = [docs_texts[start : start + BATCH_SIZE] for start in range(0, len(docs_texts), BATCH_SIZE)]
+        results: List[List[Dict[str, Any]]] = []
+        for chunk_rows in await asyncio.gather(*(_one_chunk(c) for c in chunks)):
+            results.extend(chunk_rows)
+
+        return results
+
@@ -1,6 +1,9 @@
 import base64
+import concurrent.futures
 import os
 import re
+import threading
+import time
 from dataclasses import dataclass
 from datetime import datetime, timezone
 from pathlib import Path
@@ -8,6 +11,8 @@ from typing import Any, Dict, List, Optional, Tuple
 from urllib.parse import quote
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 try:
     # Chargement automatique du fichier .env s'il existe
@@ -49,6 +54,33 @@ SUPPORTED_EXTS = {".pdf", ".jpg", ".jpeg", ".png"}
 FIREBASE_PROJECT_ID = os.getenv("FIREBASE_PROJECT_ID")
 FIREBASE_STORAGE_BUCKET = os.getenv("FIREBASE_STORAGE_BUCKET")
 FIREBASE_COLLECTION = "agent_mail_rib"
+# Document "bien connu" de la collection où l'on mémorise le dernier message
+# traité, pour court-circuiter les polls sans nouveau mail.
+FIREBASE_STATE_DOC = "_state"
+
+# Session HTTP partagée : keep-alive entre les 3+ appels Graph sériels d'un
+# run (token, dernier message, pièces jointes) au lieu d'un handshake TLS
+# par appel, avec retries automatiques sur les statuts transitoires.
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=frozenset(["GET", "POST"]),
+        ),
+    ),
+)
+
+
+# Pool dédié à l'upload Storage : permet de lancer l'upload en tâche de fond
+# et de le recouvrir avec l'OCR (les deux sont network-bound sur des backends
+# différents), au lieu de bloquer l'appelant le temps du transfert GCS.
+_UPLOAD_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="fb-upload")
 
 
 @dataclass
@@ -58,17 +90,25 @@ class MailProcessContext:
     - chemin local de la pièce jointe
     - nom de processus (id du document Firestore)
     - texte complet du mail
+    - future de l'upload Storage lancé en arrière-plan (à attendre avant la
+      mise à jour Firestore finale)
     """
 
     attachment_path: Path
     process_name: str
     mail_text: str
+    upload_future: Optional[concurrent.futures.Future] = None
+    message_id: Optional[str] = None
 
 
 class MailServiceError(RuntimeError):
     """Erreur dédiée au service de récupération d'e-mails."""
 
 
+class NoNewMailError(MailServiceError):
+    """Le dernier message de la mailbox a déjà été traité (aucun nouveau mail)."""
+
+
 def _get_env_or_raise() -> Tuple[str, str, str]:
     if not TENANT_ID or not CLIENT_ID or not CLIENT_SECRET:
         raise MailServiceError(
@@ -78,15 +118,31 @@ def _get_env_or_raise() -> Tuple[str, str, str]:
     return TENANT_ID, CLIENT_ID, CLIENT_SECRET
 
 
+# Cache du token Graph : un seul aller-retour OAuth par heure (expires_in)
+# au lieu d'un par run. Le lock évite les refresh concurrents.
+_TOKEN_CACHE: Dict[str, Any] = {"token": None, "exp": 0.0}
+_TOKEN_LOCK = threading.Lock()
+
+
 def get_graph_token() -> str:
     """
     Récupère un token OAuth2 client_credentials pour Microsoft Graph.
 
-    Inspiré de `mails/test_graph.py`.
+    Le token est mis en cache jusqu'à son expiration (champ `expires_in` de
+    la réponse OAuth, avec une marge de 60 s). Inspiré de `mails/test_graph.py`.
     """
+    with _TOKEN_LOCK:
+        if _TOKEN_CACHE["token"] and time.monotonic() < _TOKEN_CACHE["exp"] - 60:
+            return _TOKEN_CACHE["token"]
+
+        token = _fetch_graph_token()
+        return token
+
+
+def _fetch_graph_token() -> str:
     tenant_id, client_id, client_secret = _get_env_or_raise()
 
-    resp = requests.post(
+    resp = _SESSION.post(
         f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token",
         data={
             "client_id": client_id,
@@ -101,13 +157,24 @@ def get_graph_token() -> str:
     token = data.get("access_token")
     if not token:
         raise MailServiceError("Impossible de récupérer access_token depuis la réponse OAuth2.")
+
+    _TOKEN_CACHE["token"] = token
+    _TOKEN_CACHE["exp"] = time.monotonic() + float(data.get("expires_in", 3600))
     return token
 
 
-def _graph_get(url: str, token: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-    resp = requests.get(
+def _graph_get(
+    url: str,
+    token: str,
+    params: Optional[Dict[str, Any]] = None,
+    headers: Optional[Dict[str, str]] = None,
+) -> Dict[str, Any]:
+    all_headers = {"Authorization": f"Bearer {token}"}
+    if headers:
+        all_headers.update(headers)
+    resp = _SESSION.get(
         url,
-        headers={"Authorization": f"Bearer {token}"},
+        headers=all_headers,
         params=params,
         timeout=30,
     )
@@ -119,6 +186,13 @@ def _get_last_message(token: str) -> Optional[Dict[str, Any]]:
     """
     Récupère le dernier message reçu dans la mailbox (tri par receivedDateTime desc),
     avec le corps complet pour pouvoir remplir `mail_text`.
+
+    Les pièces jointes sont incluses via `$expand` : un seul aller-retour Graph
+    au lieu de deux appels sériels (message puis /attachments).
+
+    Le header `Prefer: outlook.body-content-type="text"` fait renvoyer le
+    corps en texte brut plutôt qu'en HTML : payload bien plus léger, et moins
+    de bruit (donc moins de tokens) pour l'extraction d'ids en aval.
     """
     url = f"{GRAPH_BASE_URL}/users/{MAILBOX}/messages"
     data = _graph_get(
@@ -127,8 +201,10 @@ def _get_last_message(token: str) -> Optional[Dict[str, Any]]:
         params={
             "$top": 1,
             "$orderby": "receivedDateTime desc",
-            "$select": "id,subject,receivedDateTime,body,bodyPreview",
+            "$select": "id,subject,receivedDateTime,body,bodyPreview,uniqueBody",
+            "$expand": "attachments($select=id,name,contentType,isInline,contentBytes)",
         },
+        headers={"Prefer": 'outlook.body-content-type="text"'},
     )
     values: List[Dict[str, Any]] = data.get("value") or []
     if not values:
@@ -142,10 +218,14 @@ def _get_attachments(message_id: str, token: str) -> List[Dict[str, Any]]:
     return data.get("value") or []
 
 
+# Compilée une fois à l'import (pas de lookup du cache re à chaque appel).
+_SAFE_FILENAME_RE = re.compile(r"[^A-Za-z0-9_.-]")
+
+
 def _safe_filename(name: str) -> str:
     name = name.strip() or "attachment"
     # remplace tous les caractères "sales" par underscore
-    return re.sub(r"[^A-Za-z0-9_.-]", "_", name)
+    return _SAFE_FILENAME_RE.sub("_", name)
 
 
 def _choose_best_attachment(attachments: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
@@ -154,12 +234,14 @@ def _choose_best_attachment(attachments: List[Dict[str, Any]]) -> Optional[Dict[
     - Priorité aux attachments de type fichier non inline
     - Priorité aux extensions connues (PDF/JPG/PNG)
     """
+    # Note : contentBytes n'est volontairement PAS exigé ici — Graph peut
+    # l'omettre dans un $expand tronqué (grosses pièces jointes) ; le contenu
+    # est alors re-fetché en aval via l'appel /attachments dédié.
     file_attachments = [
         att
         for att in attachments
         if att.get("@odata.type") == "#microsoft.graph.fileAttachment"
         and not att.get("isInline", False)
-        and att.get("contentBytes")
     ]
     if not file_attachments:
         return None
@@ -183,22 +265,35 @@ def _choose_best_attachment(attachments: List[Dict[str, Any]]) -> Optional[Dict[
 def _extract_mail_text_from_message(message: Dict[str, Any]) -> str:
     """
     Récupère le texte du mail à partir de l'objet message Graph.
-    Utilise de préférence body.content, sinon bodyPreview.
+    Utilise de préférence uniqueBody.content (sans l'historique de fil),
+    sinon body.content, sinon bodyPreview.
     """
-    body = message.get("body") or {}
-    content = body.get("content")
-    if content:
-        return str(content)
+    for key in ("uniqueBody", "body"):
+        content = (message.get(key) or {}).get("content")
+        if content:
+            return str(content)
     preview = message.get("bodyPreview")
     if preview:
         return str(preview)
     return ""
 
 
+# (db, bucket) mémoïsés : _init_firebase est appelé plusieurs fois par run et
+# firestore.client()/storage.bucket() reconstruisent des canaux gRPC à chaque
+# appel. Les clients sont thread-safe, une seule instance par process suffit.
+_FIREBASE_CACHE: Optional[Tuple[Any, Any]] = None
+_FIREBASE_LOCK = threading.Lock()
+
+
 def _init_firebase() -> Tuple[Any, Any]:
     """
     Initialise Firebase (Firestore + Storage) et retourne (db, bucket).
+
+    Le couple (db, bucket) est mis en cache au premier appel.
     """
+    global _FIREBASE_CACHE
+    if _FIREBASE_CACHE is not None:
+        return _FIREBASE_CACHE
     if firebase_admin is None or firestore is None or storage is None:
         raise MailServiceError(
             "Le module firebase_admin est requis pour la fonctionnalité Firebase "
@@ -209,17 +304,22 @@ def _init_firebase() -> Tuple[Any, Any]:
     if not FIREBASE_STORAGE_BUCKET:
         raise MailServiceError("FIREBASE_STORAGE_BUCKET doit être défini dans l'environnement.")
 
-    if not firebase_admin._apps:
-        firebase_admin.initialize_app(
-            options={
-                "projectId": FIREBASE_PROJECT_ID,
-                "storageBucket": FIREBASE_STORAGE_BUCKET,
-            }
-        )
+    with _FIREBASE_LOCK:
+        if _FIREBASE_CACHE is not None:
+            return _FIREBASE_CACHE
+
+        if not firebase_admin._apps:
+            firebase_admin.initialize_app(
+                options={
+                    "projectId": FIREBASE_PROJECT_ID,
+                    "storageBucket": FIREBASE_STORAGE_BUCKET,
+                }
+            )
 
-    db = firestore.client()
-    bucket = storage.bucket(FIREBASE_STORAGE_BUCKET)
-    return db, bucket
+        db = firestore.client()
+        bucket = storage.bucket(FIREBASE_STORAGE_BUCKET)
+        _FIREBASE_CACHE = (db, bucket)
+        return _FIREBASE_CACHE
 
 
 def _build_storage_object_name(process_name: str, filename: str) -> str:
@@ -282,15 +382,53 @@ def update_mail_rib_document_with_agent_output(process_name: str, agent_json: An
     )
 
 
-def download_last_mail_attachment(out_dir: Path) -> MailProcessContext:
+def mark_message_processed(message_id: str) -> None:
+    """
+    Mémorise `message_id` comme dernier message traité dans le document
+    d'état de la collection.
+
+    À appeler uniquement après succès complet de la pipeline : tant que
+    l'état n'est pas écrit, un échec en aval laisse le mail re-traitable
+    au poll suivant.
+    """
+    db, _bucket = _init_firebase()
+    state_ref = db.collection(FIREBASE_COLLECTION).document(FIREBASE_STATE_DOC)
+    state_ref.set(
+        {
+            "last_processed_msg_id": message_id,
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+        },
+        merge=True,
+    )
+
+
+def fetch_last_message() -> Dict[str, Any]:
+    """
+    Récupère le dernier message reçu sur MAILBOX (corps + pièces jointes via
+    `$expand`), sans aucun effet de bord Firebase.
+
+    Appel Graph léger (~1 RTT) utilisable en amont pour dédupliquer sur l'id
+    du message avant de lancer le travail coûteux/étatique du téléchargement.
+    """
+    token = get_graph_token()
+    message = _get_last_message(token)
+    if not message:
+        raise MailServiceError(f"Aucun message trouvé pour la mailbox {MAILBOX!r}.")
+    if not message.get("id"):
+        raise MailServiceError("Le dernier message ne contient pas de champ 'id'.")
+    return message
+
+
+def download_attachment_from_message(message: Dict[str, Any], out_dir: Path) -> MailProcessContext:
     """
-    Télécharge la pièce jointe du dernier mail reçu pour MAILBOX **et** enregistre
-    les informations associées dans Firebase (Firestore + Storage).
+    Télécharge la pièce jointe d'un message Graph déjà récupéré **et**
+    enregistre les informations associées dans Firebase (Firestore + Storage).
 
     Étapes :
     1. Initialisation Firebase et création d'un document dans la collection
        `agent_mail_rib` avec `status="created"`.
-    2. Appel Microsoft Graph pour récupérer le dernier message + sa pièce jointe.
+    2. Extraction de la pièce jointe du message (re-fetch Graph si `$expand`
+       a été tronqué).
     3. Sauvegarde de la pièce jointe en local dans `out_dir`.
     4. Upload de la pièce jointe dans le bucket `FIREBASE_STORAGE_BUCKET` dans un
        dossier contenant le nom du processus (id du document Firestore).
@@ -301,34 +439,41 @@ def download_last_mail_attachment(out_dir: Path) -> MailProcessContext:
     Retourne un `MailProcessContext` contenant le chemin local de la pièce jointe,
     le nom de processus (id du doc Firestore) et le texte du mail.
     """
-    # 1) Firebase : création du document avant de récupérer le mail
+    # 1) Firebase : réservation de l'id du document (purement local, aucun
+    # aller-retour réseau) — l'écriture Firestore est différée et fusionnée
+    # avec la mise à jour finale en un seul RPC.
     db, bucket = _init_firebase()
     collection_ref = db.collection(FIREBASE_COLLECTION)
     doc_ref = collection_ref.document()  # id auto → utilisé comme nom de processus
     process_name = doc_ref.id
 
     created_at = datetime.now(timezone.utc).isoformat()
-    doc_ref.set(
-        {
-            "status": "created",
-            "process_name": process_name,
-            "created_at": created_at,
-        }
-    )
 
-    # 2) Récupération du dernier mail via Graph
+    # Token depuis le cache (déjà récupéré par fetch_last_message) : ne sert
+    # qu'au re-fetch éventuel des pièces jointes.
     token = get_graph_token()
-    message = _get_last_message(token)
-    if not message:
-        raise MailServiceError(f"Aucun message trouvé pour la mailbox {MAILBOX!r}.")
+    msg_id = message["id"]
 
-    msg_id = message.get("id")
-    if not msg_id:
-        raise MailServiceError("Le dernier message ne contient pas de champ 'id'.")
+    # Court-circuit : si ce message est celui déjà traité au run précédent,
+    # on s'arrête ici (~1 RTT Graph) au lieu de repayer OCR + agent RIB.
+    state_ref = collection_ref.document(FIREBASE_STATE_DOC)
+    try:
+        state = state_ref.get()
+        if state.exists and state.get("last_processed_msg_id") == msg_id:
+            raise NoNewMailError(f"Dernier message {msg_id!r} déjà traité, aucun nouveau mail.")
+    except NoNewMailError:
+        raise
+    except Exception:
+        # L'état est un simple accélérateur : s'il est illisible, on traite.
+        pass
 
     mail_text = _extract_mail_text_from_message(message)
 
-    attachments = _get_attachments(msg_id, token)
+    # Pièces jointes déjà présentes dans le message via $expand ; l'appel
+    # /attachments dédié ne sert que de fallback si l'expand a été tronqué.
+    attachments = message.get("attachments") or []
+    if not attachments and message.get("hasAttachments", True):
+        attachments = _get_attachments(msg_id, token)
     if not attachments:
         raise MailServiceError("Le dernier message ne contient aucune pièce jointe.")
 
@@ -339,6 +484,15 @@ def download_last_mail_attachment(out_dir: Path) -> MailProcessContext:
     raw_name = chosen.get("name") or "attachment"
     filename = _safe_filename(raw_name)
     content_b64 = chosen.get("contentBytes")
+    if not content_b64:
+        # $expand tronqué : Graph renvoie les métadonnées mais omet
+        # contentBytes sur les grosses pièces jointes. L'appel /attachments
+        # dédié, lui, renvoie toujours le contenu complet.
+        for att in _get_attachments(msg_id, token):
+            if att.get("id") == chosen.get("id"):
+                chosen = att
+                content_b64 = att.get("contentBytes")
+                break
     if not content_b64:
         raise MailServiceError("La pièce jointe choisie ne contient pas de 'contentBytes'.")
 
@@ -352,30 +506,55 @@ def download_last_mail_attachment(out_dir: Path) -> MailProcessContext:
     target_path = out_dir / filename
     target_path.write_bytes(content)
 
-    # 4) Upload dans Firebase Storage (dossier contenant le nom du processus)
+    # 4) Upload dans Firebase Storage (dossier contenant le nom du processus),
+    # lancé en arrière-plan : l'appelant peut démarrer l'OCR pendant le
+    # transfert et attendre `upload_future` avant la mise à jour finale.
+    # upload_from_string réutilise les bytes déjà décodés en mémoire au lieu
+    # de relire target_path depuis le disque (le fichier local reste écrit
+    # pour l'OCR en aval).
     object_name = _build_storage_object_name(process_name, filename)
     blob = bucket.blob(object_name)
-    blob.upload_from_filename(str(target_path))
+    upload_future = _UPLOAD_POOL.submit(
+        blob.upload_from_string,
+        content,
+        content_type=chosen.get("contentType") or "application/octet-stream",
+    )
 
     attachment_url = _build_public_download_url(object_name)
 
-    # 5) Mise à jour du document Firestore avec l'URL et le texte du mail
-    doc_ref.update(
+    # 5) Écriture unique du document Firestore (création + infos mail) en un
+    # seul RPC. L'état "dernier message traité" n'est PAS écrit ici : il ne
+    # l'est qu'après succès complet de la pipeline (mark_message_processed),
+    # sinon un échec OCR/agent en aval ferait sauter ce mail à jamais.
+    doc_ref.set(
         {
+            "status": "created",
+            "process_name": process_name,
+            "created_at": created_at,
             "attachment_url": attachment_url,
             "mail_text": mail_text,
             "message_id": msg_id,
             "subject": message.get("subject"),
             "received_at": message.get("receivedDateTime"),
             "updated_at": datetime.now(timezone.utc).isoformat(),
-        }
+        },
     )
 
     return MailProcessContext(
         attachment_path=target_path,
         process_name=process_name,
         mail_text=mail_text,
+        upload_future=upload_future,
+        message_id=msg_id,
     )
 
 
+def download_last_mail_attachment(out_dir: Path) -> MailProcessContext:
+    """
+    Variante tout-en-un : récupère le dernier message puis télécharge sa
+    pièce jointe (voir `fetch_last_message` / `download_attachment_from_message`).
+    """
+    return download_attachment_from_message(fetch_last_message(), out_dir)
+
+
 
@@ -0,0 +1,53 @@
+"""Cache des résultats OCR, indexé par hash du contenu du PDF.
+
+L'OCR est de loin le coût dominant de la pipeline (secondes à minutes par
+document) : retraiter un PDF déjà vu ne doit coûter qu'une lecture disque.
+La clé est un BLAKE2b du contenu brut (plus rapide que MD5/SHA-256 en
+CPython), la valeur le tableau `page_texts` sérialisé en JSON.
+"""
+
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import List, Optional
+
+from ._llm_common import json_dumps, json_loads
+
+CACHE_DIR_NAME = ".ocr_cache"
+
+
+def key(pdf_bytes: bytes) -> str:
+    """Clé de cache : BLAKE2b (digest 16 octets) du contenu du document."""
+    return hashlib.blake2b(pdf_bytes, digest_size=16).hexdigest()
+
+
+def cache_path(out_root: Path, digest: str) -> Path:
+    return out_root / CACHE_DIR_NAME / f"{digest}.json"
+
+
+def load(path: Path) -> Optional[List[str]]:
+    """Retourne les page_texts en cache, ou None si absent/illisible."""
+    try:
+        data = json_loads(path.read_bytes())
+    except (OSError, ValueError):
+        return None
+    if isinstance(data, list) and all(isinstance(t, str) for t in data):
+        return data
+    return None
+
+
+def store(path: Path, page_texts: List[str]) -> None:
+    """Écrit les page_texts de façon atomique (tempfile + os.replace)."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=str(path.parent), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(json_dumps(page_texts))
+        os.replace(tmp, path)
+    except Exception:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
@@ -1,7 +1,11 @@
+import asyncio
 import base64
+import functools
 import io
 import json
+import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List, Optional
 
@@ -9,12 +13,20 @@ from openai import OpenAI
 from pdf2image import convert_from_path
 from PIL import Image
 
+log = logging.getLogger("pipeline.ocr")
+
 
 class OCRService:
-    async def extract_pages_text(self, pdf_path: str) -> List[str]:
+    async def extract_pages_text(self, pdf_path: str, concurrency: Optional[int] = None) -> List[str]:
+        raise NotImplementedError
+
+    def iter_pages_text(self, pdf_path: str, concurrency: Optional[int] = None):
+        """Générateur async de tuples (index, texte) au fil des pages OCRisées."""
         raise NotImplementedError
 
-    async def extract_name_columns(self, pdf_path: str) -> Optional[List[str]]:
+    async def extract_name_columns(
+        self, pdf_path: str, page_texts: Optional[List[str]] = None
+    ) -> Optional[List[str]]:
         raise NotImplementedError
 
 
@@ -35,14 +47,51 @@ def _get_azure_client() -> OpenAI:
     return client
 
 
-def _azure_image_to_text(client: OpenAI, image_bytes: bytes, instructions: str) -> str:
+_B64_PREFIX = b"data:image/jpeg;base64,"
+
+# Pool partagé pour tout le blocking de l'OCR (rasterisation poppler, encode
+# JPEG, appels SDK OpenAI) : les threads sont réutilisés entre documents au
+# lieu d'être recréés par asyncio.to_thread, et le plafond OCR_WORKERS borne
+# naturellement la pression sur la machine et sur les quotas Azure.
+_OCR_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("OCR_WORKERS", "8")), thread_name_prefix="ocr")
+
+
+@functools.lru_cache(maxsize=1)
+def _get_deployment() -> str:
+    """Nom du déploiement Azure, lu une fois par process au lieu d'une fois par page."""
     deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT")
+    if not deployment:
+        raise RuntimeError("AZURE_OPENAI_DEPLOYMENT non défini (nom du déploiement dans Azure)")
+    return deployment
 
-    b64 = base64.b64encode(image_bytes).decode("utf-8")
-    data_url = f"data:image/png;base64,{b64}"
+
+def _encode_page_jpeg(page_img) -> memoryview:
+    """
+    Encode une page PIL en JPEG (qualité 85) pour l'envoi au VLM.
+
+    Le JPEG s'encode nettement plus vite que le PNG sur des pages scannées
+    et produit des payloads ~3-5x plus petits → moins de CPU local et moins
+    de bande passante vers Azure, sans perte de lisibilité OCR.
+
+    Retourne une memoryview sur le buffer interne du BytesIO (getbuffer) :
+    pas de memcpy pleine taille comme avec getvalue(), b64encode accepte
+    directement un bytes-like.
+    """
+    if page_img.mode not in ("RGB", "L"):
+        page_img = page_img.convert("RGB")
+    buf = io.BytesIO()
+    page_img.save(buf, format="JPEG", quality=85)
+    return buf.getbuffer()
+
+
+def _azure_image_to_text(client: OpenAI, image_bytes, instructions: str) -> str:
+    # `image_bytes` est un bytes-like (bytes ou memoryview, cf. _encode_page_jpeg).
+    # Concaténation côté bytes puis un seul decode ascii : évite une copie
+    # pleine taille du b64 en str intermédiaire (plusieurs Mo par page).
+    data_url = (_B64_PREFIX + base64.b64encode(image_bytes)).decode("ascii")
 
     resp = client.responses.create(
-        model=deployment,
+        model=_get_deployment(),
         instructions=instructions,
         input=[
             {
@@ -54,11 +103,22 @@ def _azure_image_to_text(client: OpenAI, image_bytes: bytes, instructions: str)
             }
         ],
     )
+    # Les instructions étant octet-à-octet identiques d'une page à l'autre
+    # (constantes module), Azure doit servir le préfixe depuis son prompt
+    # cache dès la page 2. On trace le compteur pour pouvoir le vérifier.
+    if log.isEnabledFor(logging.DEBUG):
+        usage = getattr(resp, "usage", None)
+        details = getattr(usage, "prompt_tokens_details", None) or getattr(usage, "input_tokens_details", None)
+        cached = getattr(details, "cached_tokens", None)
+        if cached is not None:
+            log.debug("prompt cache: %s tokens servis depuis le cache", cached)
     return resp.output_text or ""
 
 
-def _ocr_instructions() -> str:
-    return ("""
+# Instructions hoistées en constantes module : construites une seule fois par
+# process, et octet-à-octet identiques d'un appel à l'autre — condition pour
+# que le prompt caching Azure s'applique sur la partie instructions.
+_OCR_INSTRUCTIONS = ("""
        <role>
 Tu es un expert en transcription fidèle de documents comptables/administratifs à partir d’images.
 </role>
@@ -152,29 +212,40 @@ Reproduire TOUT le texte visible avec la plus grande fidélité possible, en pr
 <sortie_uniquement>
 La réponse doit contenir UNIQUEMENT la transcription (texte et tableaux). Aucune autre phrase.
 </sortie_uniquement>
-"""
-    )
+""")
 
+_NAME_COLUMN_INSTRUCTIONS = (
+    "Retourne UNIQUEMENT une liste JSON des noms de colonnes du tableau principal s'il existe, sinon []."
+)
 
-async def _azure_ocr_full_pdf_text(pdf_path: str) -> List[str]:
+
+async def _azure_ocr_iter_pages(pdf_path: str, concurrency: Optional[int] = None):
     """
-    OCR complet d'un document PDF ou d'une image (JPG/PNG) en texte par page.
+    OCR d'un document PDF ou d'une image (JPG/PNG), page par page.
+
+    Générateur async : chaque page est émise sous forme de tuple
+    (index, texte) dès que sa réponse Azure arrive (ordre d'arrivée, pas
+    ordre du document), ce qui permet à l'appelant de recouvrir l'OCR avec
+    les étapes aval (écritures disque, etc.).
 
     - PDF : conversion via pdf2image (chaque page → image).
     - JPG/PNG : considéré comme un document 1 page.
     """
     client = _get_azure_client()
     dpi = int(os.getenv("VLM_DPI", "200"))
-    instructions = _ocr_instructions()
+    loop = asyncio.get_running_loop()
 
     path = Path(pdf_path).expanduser().resolve()
     suffix = path.suffix.lower()
 
-    page_texts: List[str] = []
-
-    # 1) Chargement des pages sous forme d'images
+    # 1) Chargement des pages sous forme d'images, via le pool pour ne pas
+    # bloquer l'event loop. thread_count parallélise la rasterisation poppler
+    # sur les cœurs disponibles.
     if suffix == ".pdf":
-        pages = convert_from_path(str(path), dpi=dpi)
+        pages = await loop.run_in_executor(
+            _OCR_POOL,
+            functools.partial(convert_from_path, str(path), dpi=dpi, fmt="jpeg", thread_count=os.cpu_count() or 1),
+        )
     elif suffix in {".jpg", ".jpeg", ".png"}:
         # Image unique → une seule "page"
         with Image.open(str(path)) as img:
@@ -182,54 +253,126 @@ async def _azure_ocr_full_pdf_text(pdf_path: str) -> List[str]:
     else:
         raise RuntimeError(f"Type de fichier non supporté pour l'OCR: {suffix}")
 
-    # 2) Envoi de chaque page au backend Vision
-    for page_img in pages:
-        with io.BytesIO() as buf:
-            page_img.save(buf, format="PNG")
-            img_bytes = buf.getvalue()
-        text = _azure_image_to_text(client, img_bytes, instructions=instructions)
-        page_texts.append(text)
-    return page_texts
+    # 2) Envoi des pages au backend Vision en concurrence : le temps mur du
+    # pipeline est dominé par N aller-retours Azure sériels, on les recouvre
+    # donc (borné par VLM_CONCURRENCY pour respecter les quotas). Les appels
+    # bloquants (encode JPEG + SDK OpenAI) passent par le pool partagé.
+    sem = asyncio.Semaphore(concurrency or int(os.getenv("VLM_CONCURRENCY", "6")))
+
+    async def _one(idx: int, page_img):
+        async with sem:
+            img_bytes = await loop.run_in_executor(_OCR_POOL, _encode_page_jpeg, page_img)
+            text = await loop.run_in_executor(
+                _OCR_POOL,
+                functools.partial(_azure_image_to_text, client, img_bytes, instructions=_OCR_INSTRUCTIONS),
+            )
+            return idx, text
+
+    tasks = [asyncio.ensure_future(_one(i, p)) for i, p in enumerate(pages)]
+    try:
+        for fut in asyncio.as_completed(tasks):
+            yield await fut
+    finally:
+        for t in tasks:
+            t.cancel()
+
+
+async def _azure_ocr_full_pdf_text(pdf_path: str, concurrency: Optional[int] = None) -> List[str]:
+    """OCR complet du document, pages remises dans l'ordre du document."""
+    results: dict[int, str] = {}
+    async for idx, text in _azure_ocr_iter_pages(pdf_path, concurrency=concurrency):
+        results[idx] = text
+    return [results[i] for i in sorted(results)]
+
+
+def _columns_from_pages(page_texts: List[str]) -> Optional[List[str]]:
+    """
+    Déduit les noms de colonnes depuis la transcription déjà produite :
+    la ligne qui suit le premier marqueur `=== TABLEAU ===` est la ligne
+    d'en-têtes (cellules séparées par `|`). Zéro appel VLM supplémentaire.
+    """
+    for pt in page_texts:
+        lines = iter(pt.splitlines())
+        for line in lines:
+            if line.strip() == "=== TABLEAU ===":
+                header = next(lines, "").strip()
+                cols = [c.strip() for c in header.split("|") if c.strip()]
+                if cols:
+                    return cols
+    return None
+
+
+def _parse_name_columns(raw: str) -> Optional[List[str]]:
+    """Parse la réponse du VLM en liste de noms de colonnes, None si invalide."""
+    out = raw.strip().removeprefix("```json").removeprefix("```").removesuffix("```").strip()
+    try:
+        data = json.loads(out)
+    except Exception:
+        return None
+    if isinstance(data, list) and all(isinstance(x, str) for x in data):
+        return data
+    return None
 
 
 async def _azure_ocr_name_column_pdf(pdf_path: str) -> Optional[List[str]]:
+    """
+    Extrait les noms de colonnes du tableau principal.
+
+    Les en-têtes sont quasi toujours sur la première page : on ne rasterise
+    que les 3 premières pages, on interroge le VLM en concurrence et on
+    retourne dès la première réponse valide (les tâches restantes sont
+    annulées) au lieu d'OCRiser tout le document séquentiellement.
+    """
     client = _get_azure_client()
     dpi = int(os.getenv("VLM_DPI", "200"))
+    loop = asyncio.get_running_loop()
 
-    pages = convert_from_path(pdf_path, dpi=dpi)
-    for page_img in pages:
-        with io.BytesIO() as buf:
-            page_img.save(buf, format="PNG")
-            img_bytes = buf.getvalue()
+    pages = await loop.run_in_executor(
+        _OCR_POOL,
+        functools.partial(
+            convert_from_path, pdf_path, dpi=dpi, fmt="jpeg", thread_count=os.cpu_count() or 1, first_page=1, last_page=3
+        ),
+    )
 
-        instructions = (
-            "Retourne UNIQUEMENT une liste JSON des noms de colonnes du tableau principal s'il existe, sinon []."
+    tasks = [
+        asyncio.ensure_future(
+            loop.run_in_executor(
+                _OCR_POOL,
+                functools.partial(_azure_image_to_text, client, _encode_page_jpeg(p), instructions=_NAME_COLUMN_INSTRUCTIONS),
+            )
         )
-        out = _azure_image_to_text(client, img_bytes, instructions=instructions).strip()
-
-        if out.startswith("```json"):
-            out = out[7:]
-        if out.startswith("```"):
-            out = out[3:]
-        if out.endswith("```"):
-            out = out[:-3]
-        out = out.strip()
-
-        try:
-            data = json.loads(out)
-            if isinstance(data, list) and all(isinstance(x, str) for x in data):
-                return data
-        except Exception:
-            continue
+        for p in pages
+    ]
+    try:
+        for fut in asyncio.as_completed(tasks):
+            cols = _parse_name_columns(await fut)
+            if cols is not None:
+                return cols
+    finally:
+        for t in tasks:
+            t.cancel()
 
     return None
 
 
 class AzureOCRService(OCRService):
-    async def extract_pages_text(self, pdf_path: str) -> List[str]:
-        return await _azure_ocr_full_pdf_text(pdf_path)
-
-    async def extract_name_columns(self, pdf_path: str) -> Optional[List[str]]:
+    async def extract_pages_text(self, pdf_path: str, concurrency: Optional[int] = None) -> List[str]:
+        return await _azure_ocr_full_pdf_text(pdf_path, concurrency=concurrency)
+
+    def iter_pages_text(self, pdf_path: str, concurrency: Optional[int] = None):
+        return _azure_ocr_iter_pages(pdf_path, concurrency=concurrency)
+
+    async def extract_name_columns(
+        self, pdf_path: str, page_texts: Optional[List[str]] = None
+    ) -> Optional[List[str]]:
+        # La transcription complète contient déjà la ligne d'en-têtes : on la
+        # réutilise (passée par l'appelant ou recalculée) plutôt que de payer
+        # une deuxième passe OCR du document. Le VLM ne sert que de fallback.
+        if page_texts is None:
+            page_texts = await self.extract_pages_text(pdf_path)
+        cols = _columns_from_pages(page_texts)
+        if cols is not None:
+            return cols
         return await _azure_ocr_name_column_pdf(pdf_path)
 
 
@@ -1,19 +1,27 @@
 import asyncio
-import json
+import hashlib
+import os
+import tempfile
 import time
+from pathlib import Path
 from typing import Optional
 
+from ._llm_common import json_dumps, json_loads
 from .config import load_config
-from .id_mail_json import _azure_text_to_json, _get_azure_client
+from .id_mail_json import extract_mail_ids
 from .mail_service import (
     MailProcessContext,
-    download_last_mail_attachment,
+    NoNewMailError,
+    download_attachment_from_message,
+    fetch_last_message,
+    mark_message_processed,
     update_mail_rib_document_with_agent_output,
     update_mail_rib_document_with_ids,
 )
 from .json_service import AzureTextToJsonService
+from . import ocr_cache
 from .ocr_service import AzureOCRService
-from .storage import prepare_paths, write_errors, write_status
+from .storage import _safe_dir_name, prepare_paths, write_status
 from .types import ProcessConfig, ProcessPaths, ProcessReport, StepResult
 from .writer import write_merged_json, write_merged_txt, write_txt_pages
 
@@ -28,26 +36,106 @@ async def run_pdf_pipeline(pdf_path: str, cfg: Optional[ProcessConfig] = None) -
     """
     cfg = cfg or load_config()
 
+    # Court-circuit skip_existing : si un run précédent a déjà produit le JSON
+    # fusionné pour ce PDF, on ressort son résultat sans copie, OCR ni appel
+    # LLM. Vérifié AVANT prepare_paths, qui allouerait sinon un nouveau
+    # dossier unique où le fichier n'existe jamais.
+    if cfg.skip_existing:
+        src = Path(pdf_path).expanduser().resolve()
+        prior_dir = cfg.out_root / _safe_dir_name(src.stem)
+        merged = prior_dir / f"{src.stem}_merged_all_pages.json"
+        if merged.exists():
+            try:
+                cached_rows = await asyncio.to_thread(_read_json, merged)
+            except Exception:
+                cached_rows = None
+            return ProcessReport(
+                pdf=str(prior_dir / f"original_{src.name}"),
+                process_dir=str(prior_dir),
+                steps=[
+                    StepResult(
+                        name="cached",
+                        ok=True,
+                        duration_sec=0.0,
+                        output_paths={"merged_json": str(merged)},
+                    )
+                ],
+                rib_rows=cached_rows if isinstance(cached_rows, list) else None,
+            )
+
     paths: ProcessPaths = prepare_paths(pdf_path, cfg.out_root)
     steps: list[StepResult] = []
     errors: dict[str, str] = {}
 
     page_texts: list[str] = []
+    rib_rows: Optional[list] = None
+
+    # Cache OCR par hash du contenu : un document déjà vu ressort du cache en
+    # quelques ms au lieu de repayer l'OCR complet. Activé par skip_existing.
+    ocr_cache_path: Optional[Path] = None
+    cached_pages: Optional[list[str]] = None
+    try:
+        # Le hash a déjà été calculé pendant la copie initiale (prepare_paths) ;
+        # on ne relit le PDF que si cette copie a échoué.
+        digest = paths.pdf_hash or ocr_cache.key(await asyncio.to_thread(paths.original_pdf_path.read_bytes))
+        ocr_cache_path = ocr_cache.cache_path(cfg.out_root, digest)
+        if cfg.skip_existing:
+            cached_pages = await asyncio.to_thread(ocr_cache.load, ocr_cache_path)
+    except OSError:
+        pass
 
     # 1) OCR → TXT (page par page + fichier TXT global)
     try:
-        t0 = time.time()
-        ocr = AzureOCRService()
-        page_texts = await ocr.extract_pages_text(str(paths.original_pdf_path))
+        t0 = time.perf_counter_ns()
+        if cached_pages is not None:
+            page_texts = cached_pages
+            if cfg.debug_pages:
+                await write_txt_pages(paths.process_dir, paths.base_name, page_texts)
+        else:
+            # Producteur/consommateur : l'OCR émet les pages au fil de l'eau
+            # (queue bornée) et les écritures debug partent dès qu'une page
+            # arrive, au lieu d'attendre la fin de toutes les pages.
+            ocr = AzureOCRService()
+            queue: asyncio.Queue = asyncio.Queue(maxsize=8)
+
+            async def _produce() -> None:
+                try:
+                    async for item in ocr.iter_pages_text(
+                        str(paths.original_pdf_path), concurrency=cfg.max_concurrency
+                    ):
+                        await queue.put(item)
+                finally:
+                    await queue.put(None)
+
+            producer = asyncio.create_task(_produce())
+            results: dict[int, str] = {}
+            debug_writes: list[asyncio.Task] = []
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                idx, text = item
+                results[idx] = text
+                if cfg.debug_pages:
+                    page_path = paths.process_dir / f"{paths.base_name}_ocr_page_{idx + 1}.txt"
+                    debug_writes.append(
+                        asyncio.create_task(asyncio.to_thread(page_path.write_bytes, text.encode("utf-8")))
+                    )
+            await producer  # propage une éventuelle erreur OCR
+            if debug_writes:
+                await asyncio.gather(*debug_writes)
+            page_texts = [results[i] for i in sorted(results)]
+            if ocr_cache_path is not None:
+                await asyncio.to_thread(ocr_cache.store, ocr_cache_path, page_texts)
 
-        # Sauvegarde page par page (debug) + fichier TXT combiné pour le text→JSON
-        write_txt_pages(paths.process_dir, paths.base_name, page_texts)
-        merged_txt_path = write_merged_txt(paths.process_dir, paths.base_name, page_texts)
+        merged_txt_path = await asyncio.to_thread(
+            write_merged_txt, paths.process_dir, paths.base_name, page_texts
+        )
         steps.append(
             StepResult(
                 name="ocr_pages_text",
                 ok=True,
-                duration_sec=time.time() - t0,
+                duration_sec=(time.perf_counter_ns() - t0) / 1e9,
                 output_paths={
                     "txt_dir": str(paths.process_dir),
                     "merged_txt": str(merged_txt_path),
@@ -68,19 +156,19 @@ async def run_pdf_pipeline(pdf_path: str, cfg: Optional[ProcessConfig] = None) -
     # 2) Texte OCR → JSON (RIB) uniquement si l'OCR a réussi
     if not errors:
         try:
-            t0 = time.time()
+            t0 = time.perf_counter_ns()
             json_svc = AzureTextToJsonService()
             rib_rows = await json_svc.text_pages_to_json(page_texts)
 
             # Écriture du JSON fusionné (toutes pages) dans `<base>_merged_all_pages.json`
-            write_merged_json(paths.process_dir, paths.base_name, rib_rows)
+            await asyncio.to_thread(write_merged_json, paths.process_dir, paths.base_name, rib_rows)
             merged_path = paths.process_dir / f"{paths.base_name}_merged_all_pages.json"
 
             steps.append(
                 StepResult(
                     name="text_to_json_rib",
                     ok=True,
-                    duration_sec=time.time() - t0,
+                    duration_sec=(time.perf_counter_ns() - t0) / 1e9,
                     output_paths={"merged_json": str(merged_path)},
                 )
             )
@@ -95,25 +183,85 @@ async def run_pdf_pipeline(pdf_path: str, cfg: Optional[ProcessConfig] = None) -
             )
             errors["text_to_json_rib"] = str(e)
 
-    # Écriture du status final (OCR + JSON, ou partiel si erreur)
-    write_status(
+    # Écriture du status final (OCR + JSON, ou partiel si erreur).
+    # Dicts construits explicitement : dataclasses.asdict recopie
+    # récursivement chaque champ (y compris output_paths) pour rien.
+    steps_payload = [
+        {
+            "name": s.name,
+            "ok": s.ok,
+            "duration_sec": s.duration_sec,
+            "output_paths": s.output_paths,
+            "error": s.error,
+        }
+        for s in steps
+    ]
+    # Écriture (open/write/rename) déportée dans un thread : l'event loop
+    # reste disponible pour les autres pipelines en vol. Les erreurs sont
+    # repliées dans status.json (clé "errors", null si aucune) : un seul
+    # fichier, une seule écriture atomique.
+    await asyncio.to_thread(
+        write_status,
         paths.process_dir,
         {
             "pdf": str(paths.original_pdf_path),
-            "steps": [s.__dict__ for s in steps],
+            "steps": steps_payload,
+            "errors": errors or None,
         },
     )
 
-    if errors:
-        write_errors(paths.process_dir, errors)
-
     return ProcessReport(
         pdf=str(paths.original_pdf_path),
         process_dir=str(paths.process_dir),
         steps=steps,
+        rib_rows=rib_rows,
     )
 
 
+async def _await_attachment_upload(ctx: MailProcessContext) -> None:
+    """Attend la fin de l'upload Storage lancé en arrière-plan (s'il existe)."""
+    if ctx.upload_future is not None:
+        await asyncio.wrap_future(ctx.upload_future)
+
+
+def _attachment_sha256(path: Path) -> str:
+    """Hash SHA256 du contenu brut d'une pièce jointe (clé de cache)."""
+    with open(path, "rb") as f:
+        # file_digest lit par blocs côté C (profite de SHA-NI quand dispo).
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def _read_json(path) -> object:
+    # json_loads (orjson si dispo) parse les bytes directement, sans décodage
+    # préalable ni passage par le parseur pur-Python.
+    with open(path, "rb") as f:
+        return json_loads(f.read())
+
+
+def _write_cache_atomic(cache_path: Path, data) -> None:
+    """Écrit le JSON de cache de façon atomique (tempfile + os.replace)."""
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=str(cache_path.parent), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(json_dumps(data))
+        os.replace(tmp, cache_path)
+    except Exception:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+# Déduplication des invocations concurrentes : si la pipeline est déclenchée
+# deux fois pour le même message (scheduler + relance manuelle), le deuxième
+# appelant attend la tâche du premier au lieu de repayer téléchargement,
+# upload Storage, création de doc Firestore, OCR et agent RIB.
+_INFLIGHT: dict[str, "asyncio.Task[ProcessReport]"] = {}
+_INFLIGHT_LOCK = asyncio.Lock()
+
+
 async def run_latest_mail_attachment_pipeline(cfg: Optional[ProcessConfig] = None) -> ProcessReport:
     """
     Pipeline étendue:
@@ -125,34 +273,121 @@ async def run_latest_mail_attachment_pipeline(cfg: Optional[ProcessConfig] = Non
     - Récupération du mail
     - Téléchargement et stockage local de la pièce jointe
     puis délègue à `run_pdf_pipeline` pour la suite.
+
+    Les invocations concurrentes portant sur le même message Graph sont
+    dédupliquées via `_INFLIGHT`.
     """
     cfg = cfg or load_config()
 
-    # On stocke la pièce jointe brute dans un sous-dossier dédié des sorties de la pipeline.
+    try:
+        # Un seul RTT Graph, sans effet de bord : on connaît l'id du dernier
+        # message AVANT toute création de doc Firestore / téléchargement, et
+        # c'est sur cet id que porte la déduplication. Un déclenchement
+        # concurrent rejoint la tâche en vol au lieu de créer un doc de
+        # process orphelin et de repayer download + upload + OCR.
+        message = await asyncio.to_thread(fetch_last_message)
+        msg_id: str = message["id"]
+
+        async with _INFLIGHT_LOCK:
+            existing = _INFLIGHT.get(msg_id)
+            if existing is None:
+                task = asyncio.create_task(_download_and_process(message, cfg))
+                _INFLIGHT[msg_id] = task
+        if existing is not None:
+            # On n'attend pas sous le lock pour ne pas sérialiser les lookups.
+            return await existing
+        try:
+            return await task
+        finally:
+            async with _INFLIGHT_LOCK:
+                _INFLIGHT.pop(msg_id, None)
+    except NoNewMailError as e:
+        # Poll sans nouveau mail : rapport vide, aucune étape coûteuse lancée.
+        return ProcessReport(
+            pdf="",
+            process_dir="",
+            steps=[
+                StepResult(
+                    name="no_new_mail",
+                    ok=True,
+                    duration_sec=0.0,
+                    error=str(e),
+                )
+            ],
+        )
+
+
+async def _download_and_process(message: dict, cfg: ProcessConfig) -> ProcessReport:
+    """Télécharge la pièce jointe d'un message déjà fetché puis lance la pipeline."""
+    # On stocke la pièce jointe brute dans un sous-dossier dédié des sorties
+    # de la pipeline. Tous les appels bloquants (Graph, Firebase, disque)
+    # passent par asyncio.to_thread pour ne pas geler l'event loop pendant
+    # que l'OCR concurrent tourne.
     mail_out_dir = cfg.out_root / "mail_attachments"
-    ctx: MailProcessContext = download_last_mail_attachment(mail_out_dir)
+    ctx: MailProcessContext = await asyncio.to_thread(
+        download_attachment_from_message, message, mail_out_dir
+    )
+    return await _process_mail_attachment(ctx, cfg)
+
+
+async def _process_mail_attachment(ctx: MailProcessContext, cfg: ProcessConfig) -> ProcessReport:
+    """Cœur de la pipeline mail (OCR + agent RIB) pour une pièce jointe déjà téléchargée."""
+
+    async def _ids_step() -> None:
+        # Extraction de l'identifiant client / contrat à partir du texte du mail
+        # (regex en priorité, fallback Azure si aucun identifiant trouvé)
+        ids = await asyncio.to_thread(extract_mail_ids, ctx.mail_text)
+        await asyncio.to_thread(update_mail_rib_document_with_ids, ctx.process_name, ids)
+
+    # L'extraction d'ids ne dépend pas de l'OCR : on la lance en tâche de
+    # fond et on ne l'attend qu'avant de retourner.
+    ids_task = asyncio.create_task(_ids_step())
 
-    # Extraction de l'identifiant client / contrat à partir du texte du mail
-    client = _get_azure_client()
-    ids = _azure_text_to_json(client, ctx.mail_text)
-    update_mail_rib_document_with_ids(ctx.process_name, ids)
+    # Déduplication : si la même pièce jointe (hash SHA256 du contenu) a déjà
+    # été traitée, on réutilise le JSON en cache et on saute OCR + agent RIB.
+    sha = await asyncio.to_thread(_attachment_sha256, ctx.attachment_path)
+    cache_path = cfg.out_root / ".cache" / f"{sha}.json"
+    if cache_path.exists():
+        agent_json = await asyncio.to_thread(_read_json, cache_path)
+        await ids_task
+        await _await_attachment_upload(ctx)
+        await asyncio.to_thread(update_mail_rib_document_with_agent_output, ctx.process_name, agent_json)
+        if ctx.message_id:
+            await asyncio.to_thread(mark_message_processed, ctx.message_id)
+        return ProcessReport(
+            pdf=str(ctx.attachment_path),
+            process_dir=str(ctx.attachment_path.parent),
+            steps=[
+                StepResult(
+                    name="attachment_cache_hit",
+                    ok=True,
+                    duration_sec=0.0,
+                    output_paths={"cached_json": str(cache_path)},
+                )
+            ],
+        )
 
-    # Ensuite, on exécute la pipeline standard sur cette pièce jointe (OCR + agent RIB).
+    # Ensuite, on exécute la pipeline standard sur cette pièce jointe (OCR +
+    # agent RIB) — l'upload Storage progresse en parallèle pendant ce temps.
     report = await run_pdf_pipeline(str(ctx.attachment_path), cfg)
 
-    # On récupère le chemin du JSON fusionné produit par l'agent RIB.
-    merged_json_path: Optional[str] = None
-    for step in report.steps:
-        if step.name == "text_to_json_rib" and step.ok:
-            merged_json_path = step.output_paths.get("merged_json")
-            if merged_json_path:
-                break
+    # L'upload doit être terminé avant la mise à jour Firestore finale
+    # (attachment_url pointe sur l'objet uploadé).
+    await ids_task
+    await _await_attachment_upload(ctx)
 
-    if merged_json_path:
+    # Les lignes RIB sont déjà en mémoire dans le rapport : pas besoin de
+    # relire/parser le JSON fusionné depuis le disque.
+    if report.rib_rows is not None:
         try:
-            with open(merged_json_path, "r", encoding="utf-8") as f:
-                agent_json = json.load(f)
-            update_mail_rib_document_with_agent_output(ctx.process_name, agent_json)
+            agent_json = report.rib_rows
+            await asyncio.to_thread(update_mail_rib_document_with_agent_output, ctx.process_name, agent_json)
+            await asyncio.to_thread(_write_cache_atomic, cache_path, agent_json)
+            # L'état "dernier message traité" n'est écrit qu'ici, une fois la
+            # sortie agent stockée : un échec en amont laisse le mail
+            # re-traitable au poll suivant.
+            if ctx.message_id:
+                await asyncio.to_thread(mark_message_processed, ctx.message_id)
         except Exception:
             # On ne fait pas échouer tout le pipeline si l'écriture Firebase échoue.
             pass
@@ -1,13 +1,93 @@
-import json
+import hashlib
+import os
 import shutil
+import string
 import uuid
 from pathlib import Path
 from typing import Dict, Tuple
 
+from ._llm_common import json_dumps_pretty
 from .types import ProcessPaths
 
+try:
+    import fcntl  # type: ignore
+except ImportError:  # pragma: no cover - plateformes non-POSIX
+    fcntl = None  # type: ignore
+
+# ioctl FICLONE (reflink) — partage des extents sur XFS/Btrfs, copie O(1).
+_FICLONE = 0x40049409
+
+
+def _zero_copy(src: Path, dst: Path) -> bool:
+    """
+    Tente de dupliquer `src` vers `dst` sans copie intégrale : hardlink
+    d'abord, puis reflink (FICLONE), puis copy_file_range (copie côté
+    kernel, zéro aller-retour userspace). Retourne False si aucun chemin
+    rapide n'a abouti. Pour de gros scans, le chemin rapide est O(1).
+    """
+    try:
+        os.link(src, dst)
+        return True
+    except OSError:
+        pass
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+                return True
+            except OSError:
+                pass
+        if hasattr(os, "copy_file_range"):
+            try:
+                size = os.fstat(fsrc.fileno()).st_size
+                copied = 0
+                while copied < size:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+                if copied >= size:
+                    return True
+            except OSError:
+                pass
+
+    return False
+
+
+def hash_and_copy(src: Path, dst: Path) -> str:
+    """
+    Copie `src` vers `dst` et retourne le blake2b-16 hex du contenu.
+
+    Si la duplication zéro-copie aboutit, le hash est calculé en un seul
+    passage de lecture streamé ; sinon, la copie de repli et le hash sont
+    fusionnés dans la même boucle (un read, un write, un update par bloc)
+    au lieu d'une copie suivie d'une relecture complète.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    if _zero_copy(src, dst):
+        with open(dst, "rb") as f:
+            while chunk := f.read(1 << 20):
+                h.update(chunk)
+    else:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            while chunk := fsrc.read(1 << 20):
+                h.update(chunk)
+                fdst.write(chunk)
+    return h.hexdigest()
+
+
+# Table de translation précalculée pour l'ASCII : str.translate passe par la
+# boucle C au lieu d'un generator Python caractère par caractère.
+_ALLOWED = set(string.ascii_letters + string.digits + "_-.")
+_TABLE = str.maketrans({chr(i): (chr(i) if chr(i) in _ALLOWED else "_") for i in range(128)})
+
 
 def _safe_dir_name(name: str) -> str:
+    if name.isascii():
+        return name.translate(_TABLE)
+    # Hors ASCII (accents, etc.) : isalnum() est plus permissif que la table,
+    # on garde l'ancien chemin pour ne pas changer les noms produits.
     return "".join(c if c.isalnum() or c in ("_", "-", ".") else "_" for c in name)
 
 
@@ -28,26 +108,39 @@ def prepare_paths(pdf_path: str, out_root: Path) -> ProcessPaths:
     base_name = pdf.stem
     process_dir = ensure_process_dir(out_root, base_name)
     original_pdf_path = process_dir / f"original_{pdf.name}"
+    pdf_hash = None
     try:
-        shutil.copy2(str(pdf), str(original_pdf_path))
+        pdf_hash = hash_and_copy(pdf, original_pdf_path)
     except Exception:
         pass
-    return ProcessPaths(run_root=out_root, process_dir=process_dir, base_name=base_name, original_pdf_path=original_pdf_path)
+    return ProcessPaths(run_root=out_root, process_dir=process_dir, base_name=base_name, original_pdf_path=original_pdf_path, pdf_hash=pdf_hash)
 
 
 def write_json(path: Path, data: Dict) -> None:
-    path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    # Sérialisation orjson (fallback stdlib) directement en bytes UTF-8 :
+    # pas de str intermédiaire ré-encodé par write_text.
+    path.write_bytes(json_dumps_pretty(data))
+
+
+def _atomic_write_bytes(path: Path, payload: bytes) -> None:
+    """
+    Écrit `payload` puis renomme (os.replace) : un crash en cours d'écriture
+    ne laisse jamais de status/errors tronqué derrière lui.
+    """
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_bytes(payload)
+    os.replace(tmp, path)
 
 
 def write_status(process_dir: Path, status: Dict) -> Path:
     p = process_dir / "status.json"
-    write_json(p, status)
+    _atomic_write_bytes(p, json_dumps_pretty(status))
     return p
 
 
 def write_errors(process_dir: Path, errors: Dict) -> Path:
     p = process_dir / "errors.json"
-    write_json(p, errors)
+    _atomic_write_bytes(p, json_dumps_pretty(errors))
     return p
 
 
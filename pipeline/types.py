@@ -5,7 +5,7 @@ from pathlib import Path
 from typing import Dict, List, Optional
 
 
-@dataclass
+@dataclass(slots=True)
 class ProcessConfig:
     """Configuration de haut niveau pour exécuter le pipeline."""
     out_root: Path
@@ -13,18 +13,26 @@ class ProcessConfig:
     mapping_backend: str = "hyperbolic"   # "hyperbolic" | "azure"
     dpi: int = 200
     skip_existing: bool = False
+    # Émet un .txt par page OCR (debug uniquement : N fichiers/syscalls en
+    # plus sur le chemin chaud). Le TXT fusionné est toujours écrit.
+    debug_pages: bool = False
+    # Borne de concurrence passée aux services Azure (pages OCR, lots JSON).
+    max_concurrency: int = 10
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class ProcessPaths:
     """Regroupe les chemins utilisés pendant le process d'un PDF."""
     run_root: Path
     process_dir: Path
     base_name: str
     original_pdf_path: Path
+    # blake2b-16 du PDF, calculé pendant la copie initiale : les consommateurs
+    # (cache OCR) le réutilisent sans relire le fichier.
+    pdf_hash: Optional[str] = None
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class StepResult:
     name: str
     ok: bool
@@ -33,11 +41,14 @@ class StepResult:
     error: Optional[str] = None
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class ProcessReport:
     pdf: str
     process_dir: str
     steps: List[StepResult]
     final_csv: Optional[str] = None
+    # Lignes RIB produites par l'agent, gardées en mémoire pour éviter aux
+    # appelants de relire/parser le JSON fusionné depuis le disque.
+    rib_rows: Optional[list] = None
 
 
@@ -1,23 +1,42 @@
+import asyncio
 from pathlib import Path
 from typing import Any, List
 
-import json
+from ._llm_common import json_dumps_pretty
 
 
-def write_txt_pages(out_dir: Path, prefix: str, page_texts: List[str]) -> None:
-    """Écrit une série de pages texte OCR dans des fichiers .txt individuels."""
-    for idx, txt in enumerate(page_texts, start=1):
-        (out_dir / f"{prefix}_ocr_page_{idx}.txt").write_text(txt, encoding="utf-8")
+async def write_txt_pages(out_dir: Path, prefix: str, page_texts: List[str]) -> None:
+    """
+    Écrit une série de pages texte OCR dans des fichiers .txt individuels.
+
+    Les écritures sont dispatchées en concurrence via asyncio.to_thread :
+    le kernel recouvre les open/write/close entre pages au lieu de les
+    sérialiser sur le thread de l'event loop. write_bytes + encodage UTF-8
+    fait en amont évite la machinerie text-mode par fichier.
+    """
+    await asyncio.gather(
+        *(
+            asyncio.to_thread((out_dir / f"{prefix}_ocr_page_{idx}.txt").write_bytes, txt.encode("utf-8"))
+            for idx, txt in enumerate(page_texts, start=1)
+        )
+    )
 
 
 def write_merged_txt(out_dir: Path, prefix: str, page_texts: List[str]) -> Path:
     """
     Écrit un fichier texte unique contenant toutes les pages OCR concaténées,
     afin que le modèle texte→JSON reçoive le document complet en une seule fois.
+
+    Les pages sont streamées une à une dans un writer bufferisé : pas de
+    concaténation "\\n\\n".join (allocation de la taille du document) ni de
+    ré-encodage UTF-8 global par write_text.
     """
-    full_text = "\n\n".join(page_texts)
     path = out_dir / f"{prefix}_ocr_all_pages.txt"
-    path.write_text(full_text, encoding="utf-8")
+    with open(path, "wb", buffering=1 << 20) as f:
+        for idx, txt in enumerate(page_texts):
+            if idx:
+                f.write(b"\n\n")
+            f.write(txt.encode("utf-8"))
     return path
 
 
@@ -27,6 +46,6 @@ def write_merged_json(out_dir: Path, prefix: str, data: Any) -> None:
     Le contenu peut être un tableau ou un objet Python sérialisable en JSON.
     """
     path = out_dir / f"{prefix}_merged_all_pages.json"
-    path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    path.write_bytes(json_dumps_pretty(data))
 
 